@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+import json
+
+def is_jsonl(filename):
+    return filename.endswith('.jsonl')
+
+def iter_json_items(filename, chunk_size=1 << 24):
+    ''' Yields (key, value) of a top-level .json dict one at a time without loading the whole file '''
+    decoder = json.JSONDecoder()
+    whitespace = ' \t\r\n'
+    with open(filename, 'r') as f:
+        state = {'buf': '', 'pos': 0, 'eof': False}
+
+        def fill():
+            more = f.read(chunk_size)
+            state['eof'] = not more
+            state['buf'] = state['buf'][state['pos']:] + more
+            state['pos'] = 0
+
+        def next_char(skip):
+            while True:
+                buf, pos = state['buf'], state['pos']
+                while pos < len(buf) and buf[pos] in skip:
+                    pos += 1
+                state['pos'] = pos
+                if pos < len(buf):
+                    return buf[pos]
+                if state['eof']:
+                    raise ValueError('Unexpected end of %s' % filename)
+                fill()
+
+        def decode():
+            while True:
+                try:
+                    value, state['pos'] = decoder.raw_decode(state['buf'], state['pos'])
+                    return value
+                except json.JSONDecodeError: # Value continues past the buffer
+                    if state['eof']:
+                        raise
+                    fill()
+
+        if next_char(whitespace) != '{':
+            raise ValueError('%s is not a .json dict' % filename)
+        state['pos'] += 1
+        while next_char(whitespace + ',') != '}':
+            key = decode()
+            next_char(whitespace) # ':'
+            state['pos'] += 1
+            next_char(whitespace)
+            yield key, decode()
+
+def iter_dataset(filename):
+    ''' Yields (cmpd, entry) of a .json or .jsonl file one compound at a time; a compound may recur in
+        .jsonl files updated with -add, and its last occurrence is the current one '''
+    if is_jsonl(filename):
+        with open(filename, 'r') as f:
+            for line in f:
+                if line.strip():
+                    for cmpd, entry in json.loads(line).items():
+                        yield cmpd, entry
+    else:
+        for cmpd, entry in iter_json_items(filename):
+            yield cmpd, entry
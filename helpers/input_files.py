@@ -5,18 +5,30 @@ from pymatgen.core.structure import Structure
 from pymatgen.core.periodic_table import Specie
 from pparBVM import GIICalculator
 from pparBVM import BVMParameterizer
+from pparBVM.calculator import CRYSTALNN_KWARGS
 from pymatgen.analysis.local_env import CrystalNN
+from dataset_io import is_jsonl, iter_json_items, iter_dataset
+from glob import glob
 import argparse
+import hashlib
+import shutil
 import json
+import os
 
 def argument_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        '-rse', '--read_structures_energies', help='path to .json file with structures and energies', type=str, required=True)
+        '-rse', '--read_structures_energies', help='path to .json/.jsonl file, or directory of .json/.jsonl chunks, with structures and energies', type=str, required=True)
     parser.add_argument(
-        '-wse', '--write_structures_energies', help='path to .json file to write structure and energies', type=str, required=True)
+        '-wse', '--write_structures_energies', help='path to .json/.jsonl file to write structure and energies', type=str, required=True)
     parser.add_argument(
         '-wp', '--write_parameters', help='path to .json file to write starting BVM parameters', type=str, required=False)
+    parser.add_argument(
+        '-ckpt', '--checkpoint', help='directory of per-rank .jsonl files where finished compounds are committed; defaults to <write_structures_energies>.parts', type=str, required=False)
+    parser.add_argument(
+        '-add', '--add_compounds', help='append new structures to the existing structures and energies and parameter files instead of rewriting them', action='store_true')
+    parser.add_argument(
+        '-rep', '--replace_structures', help='with -add, the input lists every structure of the compounds it contains; compiled structures of those compounds missing from the input are dropped', action='store_true')
     args = parser.parse_args()
 
     return args
@@ -31,23 +43,51 @@ def write_data(data, filename):
         json.dump(data, f)
     return
 
-def se_from_json(dct):
-    use_se = {}
-    for cmpd in list(dct.keys()):
-        use_se[cmpd] = {}
-        structures = [Structure.from_dict(s) for s in dct[cmpd]['structures']]
-        use_se[cmpd]['structures'] = structures
-        use_se[cmpd]['energies'] = dct[cmpd]['energies']
-    return use_se
-
-def se_to_json(dct):
-    json_se = {}
-    for cmpd in list(dct.keys()):
-        json_se[cmpd] = {}
-        structures = [s.as_dict() for s in dct[cmpd]['structures']]
-        json_se[cmpd]['structures'] = structures
-        json_se[cmpd]['energies'] = dct[cmpd]['energies']
-    return json_se
+def get_input_files(filename):
+    ''' A directory is read as sorted chunks of .json/.jsonl files '''
+    if os.path.isdir(filename):
+        return sorted(glob(os.path.join(filename, '*.json')) + glob(os.path.join(filename, '*.jsonl')))
+    return [filename]
+
+def iter_compounds(filename, rank=0, nprocs=1):
+    ''' Yields (cmpd, {'structures': [], 'energies': []}) one compound at a time.
+        Compounds are dealt round-robin over ranks; .jsonl lines of the form
+        {cmpd: {'structures': [], 'energies': []}} are only parsed by the rank that owns them '''
+    i = 0
+    for path in get_input_files(filename):
+        if is_jsonl(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    if i % nprocs == rank:
+                        for cmpd, entry in json.loads(line).items():
+                            yield cmpd, entry
+                    i += 1
+        else:
+            for cmpd, entry in iter_json_items(path):
+                if i % nprocs == rank:
+                    yield cmpd, entry
+                i += 1
+
+def structure_hash(j_structure, energy):
+    ''' Content hash of one input structure and its energy '''
+    content = json.dumps({'structure': j_structure, 'energy': energy}, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+def hashes_filename(se_filename):
+    return se_filename + '.hashes.json'
+
+def get_hashes(se_filename):
+    ''' Returns {cmpd: [structure hash]} of a compiled structures and energies file, from its index if
+        present; compounds compiled without hashes map to None '''
+    if os.path.exists(hashes_filename(se_filename)):
+        return get_data(hashes_filename(se_filename))
+    hashes = {}
+    if os.path.exists(se_filename):
+        for cmpd, entry in iter_dataset(se_filename):
+            hashes[cmpd] = entry.get('hashes')
+    return hashes
 
 def params_from_json(params):
     use_params = {'Cation': [], 'Anion': [], 'R0': [], 'B': []}
@@ -65,26 +105,43 @@ def params_to_json(params):
     json_params['B'] = params['B']
     return json_params
 
-def get_values(sed, nnf, cmpd):
+def get_pairs(params_dict, indices):
+    ''' The parameter pairs at indices of params_dict, as json '''
+    pairs = {'Cation': [], 'Anion': [], 'R0': [], 'B': []}
+    for i in sorted(set(int(i) for i in indices)):
+        pairs['Cation'].append(params_dict['Cation'][i].as_dict())
+        pairs['Anion'].append(params_dict['Anion'][i].as_dict())
+        pairs['R0'].append(params_dict['R0'][i])
+        pairs['B'].append(params_dict['B'][i])
+    return pairs
+
+def get_values(entry, hashes, nnf, known=()):
+    ''' Neighbors, equivalent sites and parameter pairs of each structure of the compound whose hash is
+        not in known; nnf must be the GIICalculator's CrystalNN so the pairs come from the stored neighbors.
+        Equivalent sites are stored as 'repeats', the number of sites equivalent to each site whose di is
+        computed and 0 for the rest, so BVMParameterizer does not redo the symmetry analysis '''
     giic = GIICalculator()
-    structures = []
-    for structure in sed[cmpd]['structures']:
+    values = {'structures': [], 'energies': [], 'hashes': [], 'params': []}
+    for j_structure, energy, s_hash in zip(entry['structures'], entry['energies'], hashes):
+        if s_hash in known:
+            continue
+        structure = Structure.from_dict(j_structure)
         neighbors = []
-        gii = giic.GII(structure)
         for i in range(len(structure)):
             nn_info = nnf.get_nn_info(structure, i)
-            site_neighbors = [nn_dict['site'].as_dict() for nn_dict in nn_info] # Make json serializable
-            neighbors.append(site_neighbors)
+            neighbors.append([nn_dict['site'] for nn_dict in nn_info])
         structure.add_site_property('neighbors', neighbors)
-        structures.append(structure)
-    return {cmpd: {'structures': structures, 'energies': sed[cmpd]['energies']}},  giic.params_dict
-
-def screen_dcts(lsts):
-    new_d = {}
-    for d in lsts:
-        if d is not None:
-            new_d.update(d)
-    return new_d
+        repeats = [0] * len(structure)
+        for site_ind, n in giic.get_site_repeats(structure):
+            repeats[site_ind] = n
+        structure.add_site_property('repeats', repeats)
+        bonds = giic.compile_bonds(structure) # Reuses the neighbors and repeats
+        structure.add_site_property('neighbors', [[n.as_dict() for n in site_neighbors] for site_neighbors in neighbors]) # Make json serializable
+        values['structures'].append(structure.as_dict())
+        values['energies'].append(energy)
+        values['hashes'].append(s_hash)
+        values['params'].append(get_pairs(giic.params_dict, bonds['index']))
+    return values
 
 def merge_dcts(lsts):
     params_dict = {'Cation': [], 'Anion': [], 'R0': [], 'B': []}
@@ -102,56 +159,231 @@ def merge_dcts(lsts):
                         pairs.append(pair)
     return params_dict
 
-def get_dct_params(sed, nnf, cmpds):
+def iter_checkpoint(checkpoint):
+    ''' Yields (cmpd, entry) for every compound committed to the checkpoint directory '''
+    for path in sorted(glob(os.path.join(checkpoint, 'rank*.jsonl'))):
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    dct = json.loads(line)
+                except json.JSONDecodeError: # Line cut short by a crash; compound is redone
+                    continue
+                for cmpd, entry in dct.items():
+                    yield cmpd, entry
+
+def index_checkpoint(checkpoint):
+    ''' Returns {cmpd: [(path, offset)]} of every complete line in the checkpoint directory '''
+    decoder = json.JSONDecoder()
+    index = {}
+    for path in sorted(glob(os.path.join(checkpoint, 'rank*.jsonl'))):
+        with open(path, 'rb') as f:
+            offset = 0
+            for line in f:
+                if line.endswith(b'\n'): # Line cut short by a crash is skipped
+                    cmpd = decoder.raw_decode(line.decode(), 1)[0] # Only the key of {cmpd: {...}}
+                    index.setdefault(cmpd, []).append((path, offset))
+                offset += len(line)
+    return index
+
+def read_committed(locations):
+    ''' Returns {hash: (structure, energy, params)} of the committed lines of one compound '''
+    committed = {}
+    for path, offset in locations:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            for cmpd, entry in json.loads(f.readline().decode()).items():
+                for s, e, h, p in zip(entry['structures'], entry['energies'], entry['hashes'], entry['params']):
+                    committed[h] = (s, e, p)
+    return committed
+
+def open_checkpoint(checkpoint, rank):
+    ''' Opens this rank's checkpoint file for appending, dropping any partially written last line '''
+    path = os.path.join(checkpoint, 'rank%s.jsonl' % rank)
+    if os.path.exists(path):
+        with open(path, 'rb+') as f:
+            data = f.read()
+            if data and not data.endswith(b'\n'):
+                f.truncate(data.rfind(b'\n') + 1)
+    return open(path, 'a')
+
+def commit_compound(f, cmpd, entry):
+    ''' Writes one finished compound and forces it to disk before moving on '''
+    f.write(json.dumps({cmpd: entry}) + '\n')
+    f.flush()
+    os.fsync(f.fileno())
+    return
+
+def run_compounds(filename, checkpoint, nnf, existing=None, replace=False):
+    ''' Computes neighbors and parameter pairs for each structure whose hash is not already in
+        checkpoint or in existing ({cmpd: [hash]} of a compiled dataset). Returns {cmpd: [hash]}
+        of the input on rank 0. With replace, compounds compiled without hashes are redone in full '''
     comm = MPI.COMM_WORLD
     nprocs = comm.Get_size()
     rank = comm.Get_rank()
 
     if rank == 0:
-        if len(cmpds) > nprocs:
-            ave, res = divmod(len(cmpds), nprocs)
-            counts = [ave + 1 if p < res else ave for p in range(nprocs)]
-            starts = [sum(counts[:p]) for p in range(nprocs)]
-            ends = [sum(counts[:p+1]) for p in range(nprocs)]
-            split_cmpds = [(starts[p], ends[p]) for p in range(nprocs)]
-        else:
-            split_cmpds = [(i, i+1) if i < len(cmpds) else (len(cmpds), len(cmpds)) for i in range(nprocs)]
+        os.makedirs(checkpoint, exist_ok=True)
+        done = {}
+        for cmpd, entry in iter_checkpoint(checkpoint):
+            done.setdefault(cmpd, set()).update(entry['hashes'])
+        print('Resuming with %s compounds already done\n' % len(done), flush=True)
+        if existing is not None:
+            for cmpd, hashes in existing.items():
+                done.setdefault(cmpd, set()).update(hashes or [])
     else:
-        split_cmpds = None
-
-    cmpds_idxs = comm.scatter(split_cmpds, root=0)
-    params_dcts = []
-    se_dicts = {}
-    for i in range(cmpds_idxs[0], cmpds_idxs[1]):
-        if cmpds_idxs[0] != cmpds_idxs[1]:
-            c_sed, c_par = get_values(sed, nnf, cmpds[i])
-            params_dcts.append(c_par)
-            se_dicts.update(c_sed)
-        else:
-            params_dcts.append({})
-            se_dicts.append({})
-    g_params_dcts = comm.gather(params_dcts, root=0)
-    g_se_dicts = comm.gather(se_dicts, root=0)
-    
+        done = None
+    done = comm.bcast(done, root=0)
+
+    current = {}
+    with open_checkpoint(checkpoint, rank) as f:
+        for cmpd, entry in iter_compounds(filename, rank, nprocs):
+            if existing is not None and cmpd in existing and existing[cmpd] is None and not replace:
+                print('%s was compiled without structure hashes; rerun without -add to update it' % cmpd, flush=True)
+                continue
+            hashes = [structure_hash(s, e) for s, e in zip(entry['structures'], entry['energies'])]
+            current[cmpd] = hashes
+            known = done.get(cmpd, set())
+            if all(h in known for h in hashes):
+                continue
+            commit_compound(f, cmpd, get_values(entry, hashes, nnf, known))
+    current_lst = comm.gather(current, root=0)
+
     if rank == 0:
-        final_params = merge_dcts(g_params_dcts)
-        final_dict = screen_dcts(g_se_dicts)
-        return final_dict, final_params 
+        current = {}
+        for dct in current_lst:
+            current.update(dct)
+        return current
+
+def iter_committed(checkpoint, current, params_lst):
+    ''' Yields (cmpd, {'structures': [], 'energies': [], 'hashes': []}) of the committed structures of
+        each compound that are in the current input, in input order, collecting their parameter pairs.
+        Structures committed before the input was edited are dropped '''
+    for cmpd, locations in index_checkpoint(checkpoint).items():
+        committed = read_committed(locations)
+        entry = {'structures': [], 'energies': [], 'hashes': [], 'nn_kwargs': CRYSTALNN_KWARGS}
+        for h in current.get(cmpd, []):
+            if h in committed:
+                s, e, p = committed[h]
+                entry['structures'].append(s)
+                entry['energies'].append(e)
+                entry['hashes'].append(h)
+                params_lst.append(p)
+        if entry['hashes']:
+            yield cmpd, entry
+
+def merge_entry(entry, new, keep=None):
+    ''' Appends the new structures of a compound to its compiled entry. With keep, a set of hashes,
+        compiled structures not in keep are dropped first; new may then be None '''
+    if entry is None:
+        return new
+    if keep is not None:
+        kept = [i for i, h in enumerate(entry.get('hashes') or []) if h in keep] # No hashes: none kept
+        entry = {'structures': [entry['structures'][i] for i in kept],
+                 'energies': [entry['energies'][i] for i in kept],
+                 'hashes': [entry['hashes'][i] for i in kept],
+                 'nn_kwargs': entry.get('nn_kwargs')}
+    if new is None:
+        return entry
+    return {'structures': entry['structures'] + new['structures'],
+            'energies': entry['energies'] + new['energies'],
+            'hashes': entry.get('hashes', []) + new['hashes'],
+            'nn_kwargs': new['nn_kwargs'] if entry.get('nn_kwargs') == new['nn_kwargs'] else None} # Mixed neighbors are not reused
+
+def write_outputs(checkpoint, current, se_filename, params_filename=None):
+    ''' Streams committed compounds into the structures and energies file one at a time '''
+    params_lst = []
+    hashes = {}
+    with open(se_filename, 'w') as f:
+        if not is_jsonl(se_filename):
+            f.write('{')
+        for i, (cmpd, entry) in enumerate(iter_committed(checkpoint, current, params_lst)):
+            hashes[cmpd] = entry['hashes']
+            if is_jsonl(se_filename):
+                f.write(json.dumps({cmpd: entry}) + '\n')
+            else:
+                f.write((', ' if i > 0 else '') + json.dumps(cmpd) + ': ' + json.dumps(entry))
+        if not is_jsonl(se_filename):
+            f.write('}')
+    write_data(hashes, hashes_filename(se_filename))
+
+    if params_filename is not None:
+        write_data(merge_dcts([params_lst]), params_filename)
+    return
+
+def append_outputs(checkpoint, current, se_filename, params_filename=None, replace=False):
+    ''' Adds committed structures to their compounds in an existing structures and energies file, and
+        any new cation-anion pairs to an existing parameter file without changing current values.
+        Without replace, the input of a compound may hold only its new structures, which are appended.
+        With replace, it holds all of them, and compiled structures missing from it are dropped.
+        Compounds not in the input are left as they are '''
+    params_lst = []
+    if params_filename is not None and os.path.exists(params_filename):
+        params_lst.append(get_data(params_filename)) # Listed first so existing pairs are kept
+    hashes = get_hashes(se_filename)
+    new = dict(iter_committed(checkpoint, current, params_lst))
+    exists = os.path.exists(se_filename)
+    if replace: # Compounds that only lost structures have nothing committed but still change
+        changed = set(cmpd for cmpd in current if cmpd in hashes and hashes[cmpd] != current[cmpd]) | set(new)
+    else:
+        changed = set(new)
+
+    def merge(cmpd, entry):
+        return merge_entry(entry, new.pop(cmpd, None), set(current[cmpd]) if replace else None)
+
+    if is_jsonl(se_filename): # Appended lines take precedence over earlier ones
+        old = {}
+        if exists:
+            for cmpd, entry in iter_dataset(se_filename):
+                if cmpd in changed:
+                    old[cmpd] = entry
+        with open(se_filename, 'a') as f:
+            for cmpd in current: # Input order
+                if cmpd not in changed:
+                    continue
+                entry = merge(cmpd, old.get(cmpd))
+                hashes[cmpd] = entry['hashes']
+                f.write(json.dumps({cmpd: entry}) + '\n')
+    else: # Copied entry by entry into a new file, swapping in the changed compounds
+        tmp_filename = se_filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            f.write('{')
+            i = 0
+            for cmpd, entry in (iter_json_items(se_filename) if exists else []):
+                if cmpd in changed:
+                    entry = merge(cmpd, entry)
+                    hashes[cmpd] = entry['hashes']
+                f.write((', ' if i > 0 else '') + json.dumps(cmpd) + ': ' + json.dumps(entry))
+                i += 1
+            for cmpd, entry in new.items():
+                hashes[cmpd] = entry['hashes']
+                f.write((', ' if i > 0 else '') + json.dumps(cmpd) + ': ' + json.dumps(entry))
+                i += 1
+            f.write('}')
+        os.replace(tmp_filename, se_filename)
+    write_data(hashes, hashes_filename(se_filename))
+
+    if params_filename is not None:
+        write_data(merge_dcts([params_lst]), params_filename)
+    return
 
 if __name__ == "__main__":
     args = argument_parser()
-    sed = get_data(args.read_structures_energies)
-    o_sed = se_from_json(sed)
-    nnf = CrystalNN()
-
-    cmpds = list(o_sed.keys()) 
-    vals = get_dct_params(o_sed, nnf, cmpds)
-    
-    if vals is not None: # rank 0 processor
-        pmg_sed, params_dict = vals[0], vals[1]
-        w_pmg_sed = se_to_json(pmg_sed)
-        write_data(w_pmg_sed, args.write_structures_energies)
-       
-        if args.write_parameters is not None:
-            w_params_dict = params_to_json(params_dict)
-            write_data(w_params_dict, args.write_parameters)
+    rank = MPI.COMM_WORLD.Get_rank()
+    nnf = CrystalNN(**CRYSTALNN_KWARGS) # Same neighbors as GIICalculator
+
+    checkpoint = args.checkpoint
+    if checkpoint is None:
+        checkpoint = args.write_structures_energies + '.parts'
+    if args.add_compounds:
+        existing = get_hashes(args.write_structures_energies) if rank == 0 else None
+        existing = MPI.COMM_WORLD.bcast(existing, root=0)
+    else:
+        existing = None
+    current = run_compounds(args.read_structures_energies, checkpoint, nnf, existing, args.replace_structures)
+
+    if rank == 0:
+        if args.add_compounds:
+            append_outputs(checkpoint, current, args.write_structures_energies, args.write_parameters, args.replace_structures)
+        else:
+            write_outputs(checkpoint, current, args.write_structures_energies, args.write_parameters)
+        shutil.rmtree(checkpoint) # Outputs complete; nothing left to resume
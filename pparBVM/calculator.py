@@ -9,6 +9,11 @@ import numpy as np
 from pymatgen.analysis.local_env import CrystalNN
 from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 
+BOND_CLASSES = ['primary', 'second_shell', 'like_charge'] # Order of classes in compiled bond arrays
+BOND_SIGNS = np.array([1, 1, -1]) # Like-charge terms are repulsive and reduce the bond valence sum
+LIKE_CHARGE_R0, LIKE_CHARGE_B = 1.0, 0.37 # Starting parameters for untabulated like-charge pairs
+CRYSTALNN_KWARGS = {'cation_anion': True, 'weighted_cn': True} # weighted CN so all neighbors counted
+
 class BVparams():
 
     def __init__(self, bv_file_path='bvparms/bvparm2020_suxuen.cif'):
@@ -74,7 +79,7 @@ class BVparams():
 
 class GIICalculator():
 
-    def __init__(self, params_dict=None, method='CrystalNN', **kwargs):
+    def __init__(self, params_dict=None, method='CrystalNN', bond_classes=None, extra_params=None, **kwargs):
         ''' site_ind: (int) indice of site in Structure obj for x-coordinates to be optimized
             params_dict: (dict) Dictionary of the form:
                 {'Cation' (PMG Specie Object): [],
@@ -82,9 +87,17 @@ class GIICalculator():
                  'R0' (Float): [],
                  'B' (Float): []}
             method: (str) method to identify nearest neighbors; currently supports "CrystalNN" and "Cutoff"
+            bond_classes: (list) extra bond classes to include; "second_shell" (cation-anion bonds beyond
+                the nearest neighbors) and/or "like_charge" (repulsive cation-cation and anion-anion bonds)
+            extra_params: (dict) Parameters of the extra bond classes, of the form:
+                {bond_class: {'Atom1' (PMG Specie Object): [],
+                              'Atom2' (PMG Specie Object): [],
+                              'R0' (Float): [],
+                              'B' (Float): []}}
             **kwargs:
                 cutoff: (float) cutoff radius if method='Cutoff'
-                neighbor_charge: (str) charge of neighbors considered; 'opposite' or 'all' '''
+                neighbor_charge: (str) charge of neighbors considered; 'opposite' or 'all'
+                extra_cutoff: (float) cutoff radius of the extra bond classes; defaults to 4.0 '''
         self.params_dict = params_dict
         self.method = method
         if self.method == 'Cutoff':
@@ -97,9 +110,26 @@ class GIICalculator():
             self.cutoff = None
             self.neighbor_charge = None
 
+        self.bond_classes = ['primary']
+        for bond_class in (bond_classes or []):
+            if bond_class not in BOND_CLASSES:
+                print('Bond class %s not supported' % bond_class)
+                sys.exit(1)
+            if bond_class not in self.bond_classes:
+                self.bond_classes.append(bond_class)
+        if self.neighbor_charge == 'all' and 'like_charge' not in self.bond_classes:
+            self.bond_classes.append('like_charge') # Like-charge neighbors within cutoff
+        self.extra_cutoff = kwargs.get('extra_cutoff', 4.0)
+        self.extra_params = {c: {'Atom1': [], 'Atom2': [], 'R0': [], 'B': []} for c in BOND_CLASSES[1:]}
+        if extra_params is not None:
+            self.extra_params.update(extra_params)
+        self.param_indices = {} # (bond_class, pair) to index in its parameter table
+        self.bvp = None
+
     def tab_bvparams(self, cation, anion):
-        bvp = BVparams()
-        val_dict = bvp.get_bv_params(str(cation.element),
+        if self.bvp is None: # Read the tabulated parameters once
+            self.bvp = BVparams()
+        val_dict = self.bvp.get_bv_params(str(cation.element),
                                      str(anion.element),
                                      cation.oxi_state,
                                      anion.oxi_state)
@@ -107,51 +137,15 @@ class GIICalculator():
         B = val_dict['B']
         return R0, B
 
-    def get_bvparams(self, site1, site2):
-        ''' site1: (pymatgen PeriodicSite obj)
-            site2: (pymatgen PeriodicSite obj) '''
-
-        def add_params(cation, anion, R0, B):
-            self.params_dict['Cation'].append(cation)
-            self.params_dict['Anion'].append(anion)
-            self.params_dict['R0'].append(R0)
-            self.params_dict['B'].append(B)
-            return
-
-        if np.sign(site1.specie.oxi_state) == 1 and np.sign(site2.specie.oxi_state) == -1:
-            cation = site1.specie
-            anion = site2.specie
-        elif np.sign(site1.specie.oxi_state) == -1 and np.sign(site2.specie.oxi_state) == 1:
-            cation = site2.specie
-            anion = site1.specie
-        else:
-            pass # Currently only supports cation/anion pairs
-
-        if self.params_dict != None: # If parameter dictionary passed OR has been written
-            try: # Look for parameters to be passed in self.params_dict first
-                params_df = pd.DataFrame.from_dict(self.params_dict)
-                entry = params_df.loc[(params_df['Cation'] == cation) & (params_df['Anion'] == anion)].iloc[0]
-                R0 = entry['R0']
-                B = entry['B']
-            except IndexError: # If Species specific parameters are not passed
-                R0, B = self.tab_bvparams(cation, anion)
-                add_params(cation, anion, R0, B)
-        else: # Backup experimental BV parameters checked and added to self.params_dict
-            self.params_dict = {'Cation': [], 'Anion': [], 'R0': [], 'B': []}
-            R0, B = self.tab_bvparams(cation, anion)
-            add_params(cation, anion, R0, B)
-
-        return R0, B
-
     def get_neighbors(self, structure, site_ind):
         ''' Returns the neighboring sites depending on the method chosen '''
         if self.method == 'CrystalNN':
-            cnn = CrystalNN(cation_anion=True, weighted_cn=True) # weighted CN so all neighbors counted
+            cnn = CrystalNN(**CRYSTALNN_KWARGS)
             nn_info = cnn.get_nn_info(structure, site_ind)
             neighbors = [nn_dict['site'] for nn_dict in nn_info]
         elif self.method == 'Cutoff':
             all_neighbors = structure.get_neighbors(structure[site_ind], r=self.cutoff)
-            if self.neighbor_charge == 'all': # Currently not supported
+            if self.neighbor_charge == 'all': # Like-charge neighbors become like_charge bonds
                 neighbors = all_neighbors
             else:
                 site_oxi = structure[site_ind].specie.oxi_state
@@ -169,64 +163,152 @@ class GIICalculator():
         equivs = sym_struct.equivalent_sites
         return equivs
 
+    def get_distance(self, site, neighbor):
+        try:
+            return neighbor.nn_distance # get distance from PeriodicNeighbor object
+        except AttributeError: # for PeriodicSite objects, which are already the neighboring image
+            return np.linalg.norm(np.subtract(neighbor.coords, site.coords))
+
+    def get_pair(self, bond_class, site1, site2):
+        ''' (Cation, Anion) species of a bond, or sorted (Atom1, Atom2) species for like-charge bonds '''
+        if bond_class == 'like_charge':
+            return tuple(sorted([site1.specie, site2.specie], key=str))
+        if np.sign(site1.specie.oxi_state) == -1:
+            return (site2.specie, site1.specie)
+        return (site1.specie, site2.specie)
+
+    def get_table(self, bond_class):
+        ''' Parameters of the bond class and the keys of its two species '''
+        if bond_class == 'primary':
+            if self.params_dict == None:
+                self.params_dict = {'Cation': [], 'Anion': [], 'R0': [], 'B': []}
+            return self.params_dict, 'Cation', 'Anion'
+        return self.extra_params[bond_class], 'Atom1', 'Atom2'
+
+    def get_param_index(self, bond_class, pair, R0=None, B=None):
+        ''' Index of the pair's R0 and B in the bond class parameters; if absent, R0 and B
+            (tabulated values by default) are added '''
+        if (bond_class, pair) in self.param_indices:
+            return self.param_indices[(bond_class, pair)]
+
+        table, atom1, atom2 = self.get_table(bond_class)
+        matches = [i for i in range(len(table[atom1])) if table[atom1][i] == pair[0] and table[atom2][i] == pair[1]]
+        if matches:
+            index = matches[0]
+        else:
+            if R0 is None and bond_class == 'like_charge':
+                R0, B = LIKE_CHARGE_R0, LIKE_CHARGE_B
+            elif R0 is None:
+                R0, B = self.tab_bvparams(pair[0], pair[1])
+            table[atom1].append(pair[0])
+            table[atom2].append(pair[1])
+            table['R0'].append(R0)
+            table['B'].append(B)
+            index = len(table['R0']) - 1
+        self.param_indices[(bond_class, pair)] = index
+        return index
+
+    def get_site_bonds(self, structure, site_ind):
+        ''' Returns (bond_class, pair, distance) for every bond of the site in self.bond_classes '''
+        site = structure[site_ind]
+        site_sign = np.sign(site.specie.oxi_state)
+        bonds = []
+        if self.method == 'CrystalNN' and 'neighbors' in structure.site_properties: # Found with CRYSTALNN_KWARGS
+            neighbors = structure.site_properties['neighbors'][site_ind]
+        else:
+            neighbors = self.get_neighbors(structure, site_ind)
+        for neighbor in neighbors:
+            if np.sign(neighbor.specie.oxi_state) != site_sign:
+                bonds.append(('primary', self.get_pair('primary', site, neighbor), self.get_distance(site, neighbor)))
+        if len(self.bond_classes) == 1:
+            return bonds
+
+        first_shell = max([bond[2] for bond in bonds], default=0) + 1e-6
+        like_cutoff = self.cutoff if self.neighbor_charge == 'all' else self.extra_cutoff
+        for neighbor in structure.get_neighbors(site, r=max(self.extra_cutoff, like_cutoff)):
+            distance = self.get_distance(site, neighbor)
+            if np.sign(neighbor.specie.oxi_state) == site_sign:
+                if 'like_charge' in self.bond_classes and distance <= like_cutoff:
+                    bonds.append(('like_charge', self.get_pair('like_charge', site, neighbor), distance))
+            elif 'second_shell' in self.bond_classes and first_shell < distance <= self.extra_cutoff:
+                bonds.append(('second_shell', self.get_pair('second_shell', site, neighbor), distance))
+        return bonds
+
+    def get_site_repeats(self, structure, use_sym=True):
+        ''' Returns (site index, number of equivalent sites) for the sites whose di are computed '''
+        if use_sym == True and 'repeats' in structure.site_properties: # Stored by helpers/input_files.py
+            return [(i, repeats) for i, repeats in enumerate(structure.site_properties['repeats']) if repeats > 0]
+        if use_sym == True:
+            try:
+                equivalent_sites_list = self.get_equivalent_sites(structure) # List of equivalent sites lists
+                return [(structure.index(site_list[0]), len(site_list)) for site_list in equivalent_sites_list]
+            except (ValueError, TypeError): # If symmetrization does not work
+                pass
+        return [(i, 1) for i in range(len(structure))]
+
+    def compile_bonds(self, structure, use_sym=True):
+        ''' Flattens the bonds of a structure into arrays, so that its GII can be re-evaluated for
+            new parameters with NumPy operations alone; see GII_from_bonds '''
+        sites, classes, indices, distances = [], [], [], []
+        oxis, weights = [], []
+        for k, (site_ind, repeats) in enumerate(self.get_site_repeats(structure, use_sym)):
+            oxis.append(structure[site_ind].specie.oxi_state)
+            weights.append(repeats)
+            for bond_class, pair, distance in self.get_site_bonds(structure, site_ind):
+                sites.append(k)
+                classes.append(BOND_CLASSES.index(bond_class))
+                indices.append(self.get_param_index(bond_class, pair))
+                distances.append(distance)
+        return {'site': np.array(sites, dtype=int),
+                'class': np.array(classes, dtype=int),
+                'index': np.array(indices, dtype=int),
+                'distance': np.array(distances, dtype=float),
+                'oxi': np.array(oxis, dtype=float),
+                'weight': np.array(weights, dtype=float),
+                'nsites': len(structure)}
+
+    def reindex_bonds(self, bonds, params_dict, extra_params):
+        ''' Maps compile_bonds arrays made by another GIICalculator, with parameters params_dict and
+            extra_params, onto this calculator's parameters; missing pairs are added with their values '''
+        tables = [params_dict] + [extra_params[c] for c in BOND_CLASSES[1:]]
+        index = bonds['index'].copy()
+        for bond_class_ind, param_ind in set(zip(bonds['class'].tolist(), bonds['index'].tolist())):
+            bond_class = BOND_CLASSES[bond_class_ind]
+            table = tables[bond_class_ind]
+            atom1, atom2 = self.get_table(bond_class)[1:]
+            pair = (table[atom1][param_ind], table[atom2][param_ind])
+            new_ind = self.get_param_index(bond_class, pair, R0=table['R0'][param_ind], B=table['B'][param_ind])
+            index[(bonds['class'] == bond_class_ind) & (bonds['index'] == param_ind)] = new_ind
+        return dict(bonds, index=index)
+
+    def get_param_arrays(self):
+        ''' R0 and B of all bond classes concatenated, and the offset of each class within them '''
+        primary = self.params_dict if self.params_dict != None else {'R0': [], 'B': []}
+        tables = [primary] + [self.extra_params[c] for c in BOND_CLASSES[1:]]
+        R0 = np.concatenate([np.array(t['R0'], dtype=float) for t in tables])
+        B = np.concatenate([np.array(t['B'], dtype=float) for t in tables])
+        offsets = np.cumsum([0] + [len(t['R0']) for t in tables[:-1]])
+        return R0, B, offsets
+
+    def GII_from_bonds(self, bonds, R0=None, B=None, offsets=None):
+        ''' Computes the GII from compile_bonds arrays; R0, B and offsets default to get_param_arrays '''
+        if R0 is None:
+            R0, B, offsets = self.get_param_arrays()
+        params = offsets[bonds['class']] + bonds['index']
+        sij = np.multiply(BOND_SIGNS[bonds['class']], self.sij(R0[params], B[params], bonds['distance']))
+        bvs = np.bincount(bonds['site'], weights=sij, minlength=len(bonds['oxi']))
+        di = np.subtract(bonds['oxi'], np.multiply(np.sign(bonds['oxi']), bvs))
+        sum_di_squared = np.sum(np.multiply(bonds['weight'], self.di_squared(di)))
+        return np.sqrt(np.divide(sum_di_squared, bonds['nsites']))
+
     def sij(self, R0, B, distance):
         sij = np.exp(np.divide(np.subtract(R0, distance), B))
         return sij
 
-    def di(self, site, neighboring_sites):
-        # Note: can edit this to include same charge interactions
-        bvs = 0
-        for neighbor in neighboring_sites:
-            try:
-                distance = neighbor.nn_distance # get distance from PeriodicNeighbor object
-            except AttributeError: # for PeriodicSite objects
-                distance = site.distance(neighbor)
-            R0, B = self.get_bvparams(site, neighbor)
-            sij = self.sij(R0, B, distance)
-            bvs += sij
-
-        Voxi = site.specie.oxi_state
-        if np.sign(Voxi) == 1:
-            return np.subtract(Voxi, bvs)
-        else:
-            return np.add(Voxi, bvs)
-
     def di_squared(self, di, weight=1):
         # Note: can change the weighting of di squared
         return np.multiply(weight, np.square(di))
 
     def GII(self, structure, use_sym=True):
         ''' Computes the GII of a pymatgen.core.structure.Structure object '''
-
-        def get_site_index_di_squared(site, structure, repeats):
-            site_index = structure.index(site)
-            #try:
-            #    neighbors = structure.site_properties['neighbors'][site_index] # If these have been added to the structure
-            #except KeyError: # No 'neighbors' dictionary key in structure or no index for neighbor
-            #    neighbors = self.get_neighbors(structure, site_index)
-            neighbors = self.get_neighbors(structure, site_index)
-            di = self.di(site, neighbors)
-            di_squared = self.di_squared(di)
-            sym_di_squared = np.multiply(repeats, di_squared)
-            return sym_di_squared
-
-        sum_di_squared = 0
-        if use_sym == True:
-            try:
-                equivalent_sites_list = self.get_equivalent_sites(structure) # List of equivalent sites lists
-                try:
-                    for site_list in equivalent_sites_list:
-                        site = site_list[0]
-                        sum_di_squared += get_site_index_di_squared(site, structure, len(site_list))
-                except ValueError: # If symmetrization does not work
-                    for site in structure:
-                        sum_di_squared += get_site_index_di_squared(site, structure, 1)
-            except TypeError: # Another issue with symmetrized sites
-                for site in structure:
-                    sum_di_squared += get_site_index_di_squared(site, structure, 1)
-        else:
-            for site in structure:
-                sum_di_squared += get_site_index_di_squared(site, structure, 1)
-
-        GII = np.sqrt(np.divide(sum_di_squared, len(structure)))
-        return GII
+        return self.GII_from_bonds(self.compile_bonds(structure, use_sym=use_sym))
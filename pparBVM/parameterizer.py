@@ -8,11 +8,17 @@ import importlib
 import sys
 
 class BVMParameterizer():
-    def __init__(self, structures_and_energies, starting_parameters):
+    def __init__(self, structures_and_energies, starting_parameters, bond_classes=None, extra_parameters=None):
+        ''' bond_classes: (list) extra GIICalculator bond classes, e.g. ['second_shell', 'like_charge']
+            extra_parameters: (dict) fixed parameters of the extra bond classes; see GIICalculator '''
         self.structures_and_energies = structures_and_energies
         self.cmpds = list(self.structures_and_energies.keys())
         self.starting_parameters = starting_parameters
         self.gs_structures_and_energies = self.get_gs_structures_and_energies()
+        self.gii_calculator = GIICalculator(params_dict=deepcopy(starting_parameters),
+                                            bond_classes=bond_classes,
+                                            extra_params=deepcopy(extra_parameters))
+        self.bonds, self.gs_bonds = self.compile_bonds()
    
     def __evaluator__(self, val):
         try:
@@ -29,29 +35,54 @@ class BVMParameterizer():
             gs_structures_and_energies[cmpd] = {'structures': [structures[min_ind]], 'energies': [energies[min_ind]]}
         return gs_structures_and_energies
 
-    def get_params_dict(self, x):
-        # Only supports R0 parameterization currently
-        params_dict = deepcopy(self.starting_parameters)
-        params_dict['R0'] = x
-        return params_dict
+    def compile_bonds(self):
+        ''' Neighbors and symmetry are found once per structure, split over the ranks and shared
+            with allgather; evaluations only redo the NumPy work '''
+        comm = MPI.COMM_WORLD
+        nprocs = comm.Get_size()
+        rank = comm.Get_rank()
+
+        keys = [(cmpd, i) for cmpd in self.cmpds for i in range(len(self.structures_and_energies[cmpd]['structures']))]
+        compiler = deepcopy(self.gii_calculator) # Pairs it tabulates are local to this rank
+        local_bonds = {}
+        for cmpd, i in keys[rank::nprocs]:
+            local_bonds[(cmpd, i)] = compiler.compile_bonds(self.structures_and_energies[cmpd]['structures'][i])
+        local_params = (compiler.params_dict, compiler.extra_params)
+
+        all_bonds = {}
+        for rank_bonds, (params_dict, extra_params) in comm.allgather((local_bonds, local_params)):
+            for key, b in rank_bonds.items(): # Same order on every rank, so parameter indices agree
+                all_bonds[key] = self.gii_calculator.reindex_bonds(b, params_dict, extra_params)
+
+        bonds, gs_bonds = {}, {}
+        for cmpd in self.cmpds:
+            bonds[cmpd] = [all_bonds[(cmpd, i)] for i in range(len(self.structures_and_energies[cmpd]['structures']))]
+            energies = self.structures_and_energies[cmpd]['energies']
+            gs_bonds[cmpd] = bonds[cmpd][energies.index(min(energies))]
+        return bonds, gs_bonds
+
+    def get_param_arrays(self, x):
+        # Tabulated pairs missing from the starting parameters keep their values
+        R0, B, offsets = self.gii_calculator.get_param_arrays()
+        R0[:len(x)] = x
+        return R0, B, offsets
 
-    def mean_GIIGS(self, gii_calculator):
+    def mean_GIIGS(self, param_arrays):
         GS_GIIs = 0
         for cmpd in self.cmpds:
-            gii = gii_calculator.GII(self.gs_structures_and_energies[cmpd]['structures'][0])
+            gii = self.gii_calculator.GII_from_bonds(self.gs_bonds[cmpd], *param_arrays)
             GS_GIIs += gii
         return np.divide(GS_GIIs, len(self.cmpds))
 
     def mu_GIIGS(self, x):
-        params = self.get_params_dict(x)
-        GIIcalc = GIICalculator(params_dict=params)
-        val = self.mean_GIIGS(GIIcalc)
+        param_arrays = self.get_param_arrays(x)
+        val = self.mean_GIIGS(param_arrays)
         return val
 
-    def mean_Pearson(self, gii_calculator):
+    def mean_Pearson(self, param_arrays):
         Pearsons = 0
         for cmpd in self.cmpds:
-            giis = [gii_calculator.GII(s) for s in self.structures_and_energies[cmpd]['structures']]
+            giis = [self.gii_calculator.GII_from_bonds(b, *param_arrays) for b in self.bonds[cmpd]]
             energies = self.structures_and_energies[cmpd]['energies']
             if len(giis) > 1 and len(energies) > 1: # Pearsons of compositions with > 1 structure 
                 pearson = pearsonr(giis, energies)[0]
@@ -59,9 +90,8 @@ class BVMParameterizer():
         return np.divide(Pearsons, len(self.cmpds))
 
     def mu_Pearson(self, x, C=0.75):
-        params = self.get_params_dict(x)
-        GIIcalc = GIICalculator(params_dict=params)
-        pearson = self.mean_Pearson(GIIcalc)
+        param_arrays = self.get_param_arrays(x)
+        pearson = self.mean_Pearson(param_arrays)
         val = C - pearson
         return val
 
@@ -6,6 +6,7 @@ from pymatgen.core.structure import PeriodicSite, PeriodicNeighbor
 from pymatgen.core.periodic_table import Specie
 from pparBVM import GIICalculator
 from pparBVM import BVMParameterizer
+from pparBVM.calculator import CRYSTALNN_KWARGS
 from scipy.stats import pearsonr
 from copy import deepcopy
 import argparse
@@ -25,13 +26,23 @@ def argument_parser():
         '-opt', '--optimizer_options', help='.json convertible str of pyOpt optimizer options, form \'{"key": "value"}\'', type=json.loads, required=True)
     parser.add_argument(
         '-wp', '--write_parameters', help='path to .json file of parameterized bond valence parameters', type=str, required=False)
+    parser.add_argument(
+        '-bc', '--bond_classes', help='extra GII bond classes to include', nargs='+', choices=['second_shell', 'like_charge'], required=False)
+    parser.add_argument(
+        '-rxp', '--read_extra_parameters', help='path to .json file with parameters of the extra bond classes, form {bond_class: {"Atom1": [], "Atom2": [], "R0": [], "B": []}}', type=str, required=False)
     args = parser.parse_args()
 
     return args
 
 def get_data(filename):
     with open(filename, 'r') as f:
-        data = json.load(f)
+        if filename.endswith('.jsonl'): # One {cmpd: {...}} per line; later lines take precedence
+            data = {}
+            for line in f:
+                if line.strip():
+                    data.update(json.loads(line))
+        else:
+            data = json.load(f)
     return data
 
 def get_site_neighbors(j_structure):
@@ -58,9 +69,12 @@ def get_structures_energies(dct):
         use_se[cmpd] = {}
         structures = []
         for j_structure in dct[cmpd]['structures']:
-            neighbors = get_site_neighbors(j_structure)
             structure = Structure.from_dict(sanitize_structure(j_structure))
-            structure.add_site_property('neighbors', neighbors) 
+            if dct[cmpd].get('nn_kwargs') == CRYSTALNN_KWARGS: # Otherwise GIICalculator finds its own neighbors
+                neighbors = get_site_neighbors(j_structure)
+                structure.add_site_property('neighbors', neighbors)
+            if 'repeats' in j_structure['sites'][0]['properties']: # Otherwise GIICalculator finds equivalent sites
+                structure.add_site_property('repeats', [site['properties']['repeats'] for site in j_structure['sites']])
             structures.append(structure)
         use_se[cmpd]['structures'] = structures
         use_se[cmpd]['energies'] = dct[cmpd]['energies']
@@ -81,6 +95,16 @@ def get_parameters(params):
     use_params['B'] = params['B']
     return use_params
 
+def get_extra_parameters(params):
+    use_params = {}
+    for bond_class in list(params.keys()):
+        use_params[bond_class] = {'Atom1': [], 'Atom2': [], 'R0': [], 'B': []}
+        use_params[bond_class]['Atom1'] = [Specie.from_dict(a) for a in params[bond_class]['Atom1']]
+        use_params[bond_class]['Atom2'] = [Specie.from_dict(a) for a in params[bond_class]['Atom2']]
+        use_params[bond_class]['R0'] = params[bond_class]['R0']
+        use_params[bond_class]['B'] = params[bond_class]['B']
+    return use_params
+
 def write_data(data, filename):
     with open(filename, 'w') as f:
         json.dump(data, f)
@@ -108,6 +132,10 @@ if __name__ == '__main__':
 
     params = get_data(args.read_parameters)
     oparams = get_parameters(params)
+    if args.read_extra_parameters is not None:
+        oextra_params = get_extra_parameters(get_data(args.read_extra_parameters))
+    else:
+        oextra_params = None
 
     if rank == 0:
         print('Optimizing %s parameters over %s structures comprising %s compositions\n' % (len(oparams['Cation']), scount, len(osed)), flush=True)
@@ -118,7 +146,7 @@ if __name__ == '__main__':
     if rank == 0:
         ### Parameterize using starting dictionaries ###
         print('Parameterizing...', flush=True)
-    bvmp = BVMParameterizer(osed, oparams)
+    bvmp = BVMParameterizer(osed, oparams, bond_classes=args.bond_classes, extra_parameters=oextra_params)
     new_params = bvmp.optimizer(algo=args.algorithm, kwargs=args.optimizer_kwargs, options=args.optimizer_options)
     json_params = params_to_json(new_params)
     if args.write_parameters is not None:
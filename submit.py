@@ -1,15 +1,185 @@
 import os
+import re
+import json
+import sys
+import math
+import time
 import argparse
+import subprocess
+from helpers.dataset_io import iter_dataset
 
+### Default cost model, in seconds and bytes; scaled by calibrate() ###
+COST = {'compile_per_site': 0.05, # Symmetry (and CrystalNN without stored neighbors) per site, split over the ranks each job
+        'eval_per_structure': 5e-5, # NumPy overhead of GII_from_bonds per structure
+        'eval_per_bond': 5e-8,
+        'mem_per_json_byte': 10, # pymatgen objects relative to their .json size
+        'mem_per_bond': 40,
+        'mem_base': 5e8}
+STOCHASTIC = ['ALPSO', 'NSGA2', 'ALHSO'] # Seeded from the clock unless the 'seed' option is set
+SEED = '1.0' # A str, as BVMParameterizer.__evaluator__ evals every option; pyOpt seeds are floats
 
-def write(nodes, cores, time, out, alloc, script, read_se, read_p, write_p, algo, kwargs, options):
+
+def get_data(filename):
+    with open(filename, 'r') as f:
+        data = json.load(f)
+    return data
+
+
+def count_dataset(read_se, read_p, sample=0):
+    ''' Counts compounds, structures, sites and bonds (stored neighbors) of the dataset in one streamed
+        pass, keeping the first sample (structure, stored neighbors settings) for calibrate(). Only the
+        last occurrence of a compound counts, as in run_parameterization.py '''
+    counts = {'compounds': 0, 'structures': 0, 'sites': 0, 'bonds': 0,
+              'bytes': os.path.getsize(read_se), 'parameters': len(get_data(read_p)['Cation'])}
+    cmpd_counts = {}
+    sample_structures = []
+    for cmpd, entry in iter_dataset(read_se):
+        cmpd_count = {'structures': 0, 'sites': 0, 'bonds': 0}
+        for j_structure in entry['structures']:
+            if len(sample_structures) < sample:
+                sample_structures.append((j_structure, entry.get('nn_kwargs')))
+            cmpd_count['structures'] += 1
+            for site in j_structure['sites']:
+                cmpd_count['sites'] += 1
+                cmpd_count['bonds'] += len(site.get('properties', {}).get('neighbors', []))
+        cmpd_counts[cmpd] = cmpd_count # Replaces the compound's earlier lines in .jsonl files updated with -add
+    counts['compounds'] = len(cmpd_counts)
+    for cmpd_count in cmpd_counts.values():
+        for key in cmpd_count:
+            counts[key] += cmpd_count[key]
+    return counts, sample_structures
+
+
+def calibrate(sample_structures):
+    ''' Times bond compilation and GII evaluation of the sample structures, with their stored
+        neighbors and equivalent sites as in run_parameterization.py, and returns the factors by
+        which they differ from the default cost model. The first structure is compiled once untimed,
+        so loading the BV table and the first parameter lookups are not counted '''
+    from pymatgen.core.structure import Structure, PeriodicSite
+    from pparBVM import GIICalculator
+    from pparBVM.calculator import CRYSTALNN_KWARGS
+
+    structures = []
+    for j_structure, nn_kwargs in sample_structures:
+        properties = [site.pop('properties', {}) for site in j_structure['sites']]
+        structure = Structure.from_dict(j_structure)
+        if nn_kwargs == CRYSTALNN_KWARGS:
+            structure.add_site_property('neighbors', [[PeriodicSite.from_dict(n) for n in p['neighbors']] for p in properties])
+        if 'repeats' in properties[0]:
+            structure.add_site_property('repeats', [p['repeats'] for p in properties])
+        structures.append(structure)
+
+    giic = GIICalculator()
+    giic.compile_bonds(structures[0]) # Warm up
+    t_compile, t_eval, sites, bonds = 0, 0, 0, 0
+    for structure in structures:
+        start = time.time()
+        compiled = giic.compile_bonds(structure)
+        t_compile += time.time() - start
+        start = time.time()
+        giic.GII_from_bonds(compiled)
+        t_eval += time.time() - start
+        sites += len(structure)
+        bonds += len(compiled['distance'])
+    eval_model = len(sample_structures) * COST['eval_per_structure'] + bonds * COST['eval_per_bond']
+    return {'compile': t_compile / (sites * COST['compile_per_site']),
+            'eval': t_eval / eval_model}
+
+
+def get_groups(params, algo, kwargs, options):
+    ''' Number of function evaluations pyOpt can run at once; 1 unless pll_type is set '''
+    if 'pll_type' not in kwargs:
+        return 1
+    for key in ['SwarmSize', 'PopSize']: # Population-based optimizers
+        if key in options:
+            return int(options[key])
+    if algo == 'ALPSO':
+        return 40
+    if algo == 'NSGA2':
+        return 100
+    return params + 1 # Finite-difference gradient over each parameter
+
+
+def get_sweep_groups(params, algo, kwargs, options, sweep):
+    ''' Largest get_groups over the array tasks, which share one --tasks '''
+    return max(get_groups(params, overrides.get('algorithm', algo),
+                          dict(kwargs, **overrides.get('optimizer_kwargs', {})),
+                          dict(options, **overrides.get('optimizer_options', {})))
+               for overrides in (sweep if sweep is not None else [{}]))
+
+
+def estimate(counts, groups, evaluations, cores, node_memory, scale=None, nodes=None):
+    ''' Returns the ranks, nodes, seconds of setup per job, seconds of optimization
+        and memory per rank for the dataset; nodes are sized by memory unless given '''
+    if scale is None:
+        scale = {'compile': 1, 'eval': 1}
+    # mean_Pearson evaluates every structure and mu_GIIGS every ground state
+    eval_structures = counts['structures'] + counts['compounds']
+    t_eval = scale['eval'] * (eval_structures * COST['eval_per_structure'] \
+                                + counts['bonds'] * (eval_structures / counts['structures']) * COST['eval_per_bond'])
+    mem = COST['mem_base'] + counts['bytes'] * COST['mem_per_json_byte'] + counts['bonds'] * COST['mem_per_bond']
+
+    ranks_per_node = max(1, min(cores, int(node_memory * 1e9 // mem)))
+    if nodes is None:
+        nodes = math.ceil(groups / ranks_per_node)
+    ranks = min(groups, nodes * ranks_per_node)
+    t_init = scale['compile'] * counts['sites'] * COST['compile_per_site'] / ranks
+    t_opt = evaluations * t_eval / ranks
+    return {'ranks': ranks, 'nodes': nodes, 'init': t_init, 'opt': t_opt, 'mem': mem}
+
+
+def get_chain(est, max_hours, safety=1.5):
+    ''' Splits the estimated run into jobs of at most max_hours; returns (jobs, hours per job) '''
+    t_init, t_opt = safety * est['init'], safety * est['opt']
+    per_job = max_hours * 3600 - t_init
+    if per_job <= 0:
+        print('Setup alone exceeds %s hours; exiting' % max_hours)
+        sys.exit(1)
+    jobs = max(1, math.ceil(t_opt / per_job))
+    hours = min(max_hours, math.ceil((t_init + t_opt / jobs) / 3600))
+    return jobs, hours
+
+
+def get_history(out):
+    ''' pyOpt history file name; kept an identifier so BVMParameterizer.__evaluator__ leaves it a str '''
+    return 'hist_' + re.sub(r'\W', '_', out)
+
+
+def get_tasks(algo, kwargs, options, sweep, out, write_p, resume, chained=False):
+    ''' Returns (algo, kwargs, options, write_p) per array task; a single task without sweep.
+        Chained stochastic optimizers get a fixed seed so hot_start replays the same points '''
+    tasks = []
+    for i, overrides in enumerate(sweep if sweep is not None else [{}]):
+        t_kwargs = dict(kwargs, **overrides.get('optimizer_kwargs', {}))
+        t_options = dict(options, **overrides.get('optimizer_options', {}))
+        history = get_history(out) if sweep is None else get_history(out) + '_' + str(i)
+        t_kwargs['store_hst'] = history
+        if resume:
+            t_kwargs['hot_start'] = history
+        t_algo = overrides.get('algorithm', algo)
+        if chained and t_algo in STOCHASTIC and not t_options.get('seed'):
+            t_options['seed'] = SEED
+        if write_p is not None and sweep is not None:
+            t_write_p = os.path.splitext(write_p)[0] + '_' + str(i) + os.path.splitext(write_p)[1]
+        else:
+            t_write_p = write_p
+        tasks.append((t_algo, json.dumps(t_kwargs), json.dumps(t_options), t_write_p))
+    return tasks
+
+
+def write(nodes, ranks, time, out, alloc, script, read_se, read_p, tasks, filename='submit.sh', layout=None):
     writelines = '#!/bin/bash' + '\n'
     writelines += '#SBATCH -J ' + out + '\n'
     writelines += '#SBATCH --time=' + str(time) + ':00:00' + '\n'
     writelines += '#SBATCH -N ' + str(nodes) + '\n'
-    writelines += '#SBATCH --tasks ' + str(cores) + '\n'
-    writelines += '#SBATCH -o ' + out + '-%j.out' + '\n'
-    writelines += '#SBATCH -e ' + out + '-%j.err' + '\n'
+    writelines += '#SBATCH --tasks ' + str(ranks) + '\n'
+    if len(tasks) > 1:
+        writelines += '#SBATCH --array=0-' + str(len(tasks) - 1) + '\n'
+        writelines += '#SBATCH -o ' + out + '-%A_%a.out' + '\n'
+        writelines += '#SBATCH -e ' + out + '-%A_%a.err' + '\n'
+    else:
+        writelines += '#SBATCH -o ' + out + '-%j.out' + '\n'
+        writelines += '#SBATCH -e ' + out + '-%j.err' + '\n'
     writelines += '#SBATCH --account=' + alloc + '\n'
     if time == 1:
         writelines += '#SBATCH --partition=debug\n'
@@ -19,25 +189,65 @@ def write(nodes, cores, time, out, alloc, script, read_se, read_p, write_p, algo
         writelines += '#SBATCH --partition=long\n'
     else:
         writelines += '#SBATCH --partition=standard\n'
+    if layout is not None:
+        writelines += '# ' + layout + '\n'
 
-    writelines += 'srun'+' -n '+str(nodes*cores)+' python '+script+' -rse '+read_se+' -rp '+read_p+' -wp '+write_p+' -algo '+algo+' -kw '+"\'{0}\'".format(kwargs)+' -opt '+"\'{0}\'".format(options)+'\n'
+    lines = []
+    for algo, kwargs, options, write_p in tasks:
+        line = 'srun'+' -n '+str(ranks)+' python '+script+' -rse '+read_se+' -rp '+read_p
+        if write_p is not None:
+            line += ' -wp '+write_p
+        line += ' -algo '+algo+' -kw '+"\'{0}\'".format(kwargs)+' -opt '+"\'{0}\'".format(options)+'\n'
+        lines.append(line)
+    if len(lines) > 1:
+        writelines += 'case $SLURM_ARRAY_TASK_ID in\n'
+        for i, line in enumerate(lines):
+            writelines += '    ' + str(i) + ') ' + line.rstrip('\n') + ' ;;\n'
+        writelines += 'esac\n'
+    else:
+        writelines += lines[0]
     writelines +='exit 0'+'\n'
 
-    with open('submit.sh', 'w') as f:
+    with open(filename, 'w') as f:
         f.write(writelines)
 
 
+def sbatch(filename, dependency=None):
+    ''' Submits filename and returns its job id '''
+    command = ['sbatch', '--parsable']
+    if dependency is not None: # Only a failed or timed-out job hands off; a finished one cancels the rest
+        command += ['--dependency=afternotok:' + dependency, '--kill-on-invalid-dep=yes']
+    command.append(filename)
+    return subprocess.run(command, check=True, capture_output=True, text=True).stdout.strip().split(';')[0]
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
 
     ### General SC run arguments ###
-    parser.add_argument('-n', '--nodes', help = 'Number of nodes',
-                        type = int, default = 1)
-    parser.add_argument('-c', '--cores', help = 'Number of cores',
+    parser.add_argument('-n', '--nodes', help = 'Number of nodes; estimated from the dataset if not given',
+                        type = int, default = None)
+    parser.add_argument('-c', '--cores', help = 'Number of cores per node',
                         type = int, default = 36)
-    parser.add_argument('-t', '--time', help = 'Time limit',
-                        type = int, default = 4)
+    parser.add_argument('-m', '--node_memory', help = 'Usable memory per node (GB)',
+                        type = float, default = 180)
+    parser.add_argument('-t', '--time', help = 'Time limit per job (hours); estimated from the dataset if not given',
+                        type = int, default = None)
+    parser.add_argument('-mt', '--max_time', help = 'Longest job (hours) to request before chaining',
+                        type = int, default = 48)
+    parser.add_argument('-j', '--jobs', help = 'Number of chained jobs; estimated from the dataset if not given',
+                        type = int, default = None)
+    parser.add_argument('-ne', '--evaluations', help = 'Expected number of objective evaluations',
+                        type = int, default = 1000)
+    parser.add_argument('-cal', '--calibrate', help = 'Number of structures to time before estimating; 0 uses the default cost model',
+                        type = int, default = 3)
+    parser.add_argument('-sw', '--sweep', help = '.json convertible str of a list of independent runs submitted as a job array, form \'[{"algorithm": "", "optimizer_kwargs": {}, "optimizer_options": {}}]\'',
+                        type = json.loads, default = None)
+    parser.add_argument('-r', '--resume', help = 'Hot start the first job from its pyOpt history file',
+                        action = 'store_true')
+    parser.add_argument('-dry', '--dry_run', help = 'Write the job scripts and print the estimate without submitting',
+                        action = 'store_true')
     parser.add_argument('-o', '--outfile', help = 'Outfile name',
                         type = str, required = True)
     parser.add_argument('-a', '--allocation', help = 'Allocation',
@@ -53,13 +263,40 @@ if __name__ == '__main__':
     parser.add_argument(
         '-algo', '--algorithm', help='pyOpt algorithm to use', type=str, required=True)
     parser.add_argument(
-        '-kw', '--optimizer_kwargs', help='.json convertible str of pyOpt optimizer kwargs, form \'{"key": "value"}\'', type=str, required=True)
+        '-kw', '--optimizer_kwargs', help='.json convertible str of pyOpt optimizer kwargs, form \'{"key": "value"}\'', type=json.loads, required=True)
     parser.add_argument(
-        '-opt', '--optimizer_options', help='.json convertible str of pyOpt optimizer options, form \'{"key": "value"}\'', type=str, required=True)
+        '-opt', '--optimizer_options', help='.json convertible str of pyOpt optimizer options, form \'{"key": "value"}\'', type=json.loads, required=True)
     parser.add_argument(
         '-wp', '--write_parameters', help='path to .json file of parameterized bond valence parameters', type=str, required=False)
     args = parser.parse_args()
 
-    write(args.nodes, args.cores, args.time, args.outfile, args.allocation,
-          args.script, args.read_structures_energies, args.read_parameters, args.write_parameters, args.algorithm, args.optimizer_kwargs, args.optimizer_options)
-    os.system('sbatch submit.sh')
+    ### Estimate the run from the dataset ###
+    counts, sample_structures = count_dataset(args.read_structures_energies, args.read_parameters, args.calibrate)
+    if sample_structures:
+        scale = calibrate(sample_structures)
+    else:
+        scale = {'compile': 1, 'eval': 1}
+    groups = get_sweep_groups(counts['parameters'], args.algorithm, args.optimizer_kwargs, args.optimizer_options, args.sweep)
+    est = estimate(counts, groups, args.evaluations, args.cores, args.node_memory, scale, nodes=args.nodes)
+    jobs, hours = get_chain(est, args.time if args.time is not None else args.max_time)
+
+    nodes, ranks = est['nodes'], est['ranks']
+    hours = args.time if args.time is not None else hours
+    jobs = args.jobs if args.jobs is not None else jobs
+    layout = '%s population groups x 1 data shard; %.2f GB per rank; %.0f s setup, %.0f s optimization (estimated)' \
+                % (ranks, est['mem'] / 1e9, est['init'], est['opt'])
+    print('%s compounds, %s structures, %s bonds' % (counts['compounds'], counts['structures'], counts['bonds']))
+    print('%s; %s chained job(s) of %s hours on %s node(s)' % (layout, jobs, hours, nodes))
+
+    ### Write and submit the chain ###
+    for i, filename in enumerate(['submit.sh', 'resume.sh'][:min(jobs, 2)]):
+        tasks = get_tasks(args.algorithm, args.optimizer_kwargs, args.optimizer_options, args.sweep,
+                          args.outfile, args.write_parameters, resume=(i > 0 or args.resume),
+                          chained=(jobs > 1 or args.resume))
+        write(nodes, ranks, hours, args.outfile, args.allocation, args.script,
+              args.read_structures_energies, args.read_parameters, tasks, filename=filename, layout=layout)
+    if not args.dry_run:
+        job_id = sbatch('submit.sh')
+        for i in range(jobs - 1):
+            job_id = sbatch('resume.sh', dependency=job_id)
+        print('Submitted; last job %s' % job_id)